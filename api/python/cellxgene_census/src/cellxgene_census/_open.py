@@ -6,10 +6,14 @@
 
 Contains methods to open publicly hosted versions of Census object and access its source datasets.
 """
+import contextlib
 import logging
 import os.path
 import urllib.parse
-from typing import Any, Dict, Optional
+from collections import deque
+from concurrent import futures
+from concurrent.futures import Future
+from typing import Any, Deque, Dict, Optional
 
 import certifi
 import s3fs
@@ -28,6 +32,11 @@ DEFAULT_TILEDB_CONFIGURATION: Dict[str, Any] = {
     "vfs.s3.ca_file": certifi.where(),
 }
 
+# Source H5ADs are downloaded as concurrent byte-range requests, which is substantially faster than a single stream.
+# Peak memory use is approximately DOWNLOAD_BLOCK_SIZE * DOWNLOAD_MAX_WORKERS.
+DOWNLOAD_BLOCK_SIZE = 8 * 1024**2
+DOWNLOAD_MAX_WORKERS = 8
+
 api_logger = logging.getLogger("cellxgene_census")
 api_logger.setLevel(logging.INFO)
 api_logger.addHandler(logging.StreamHandler())
@@ -154,7 +163,17 @@ def open_soma(
     return _open_soma(description["soma"], context)
 
 
-def get_source_h5ad_uri(dataset_id: str, *, census_version: str = DEFAULT_CENSUS_VERSION) -> CensusLocator:
+def _get_dataset_h5ad_path(census: soma.Collection, dataset_id: str) -> str:
+    """Private. Return the source H5AD path for ``dataset_id``, relative to the Census ``h5ads`` URI."""
+    dataset = census["census_info"]["datasets"].read(value_filter=f"dataset_id == '{dataset_id}'").concat().to_pandas()
+    if len(dataset) == 0:
+        raise KeyError("Unknown dataset_id")
+    return str(dataset.dataset_h5ad_path.iloc[0])
+
+
+def get_source_h5ad_uri(
+    dataset_id: str, *, census_version: str = DEFAULT_CENSUS_VERSION, census: Optional[soma.Collection] = None
+) -> CensusLocator:
     """Open the named version of the census, and return the URI for the ``dataset_id``. This
     does not guarantee that the H5AD exists or is accessible to the user.
 
@@ -163,12 +182,16 @@ def get_source_h5ad_uri(dataset_id: str, *, census_version: str = DEFAULT_CENSUS
             The ``dataset_id`` of interest.
         census_version:
             The census version. Defaults to `stable`.
+        census:
+            An open Census, used to look up the ``dataset_id``. It must be the Census named by
+            ``census_version``. If not specified, the Census will be opened and closed by this function.
 
     Returns:
         A :py:obj:`CensusLocator` object that contains the URI and optional S3 region for the source H5AD.
 
     Raises:
         KeyError: if either `dataset_id` or `census_version` do not exist.
+        ValueError: if ``census`` is not the Census named by ``census_version``.
 
     Lifecycle:
         maturing
@@ -179,18 +202,49 @@ def get_source_h5ad_uri(dataset_id: str, *, census_version: str = DEFAULT_CENSUS
         's3_region': 'us-west-2'}
     """
     description = get_census_version_description(census_version)  # raises
-    census = _open_soma(description["soma"])
-    dataset = census["census_info"]["datasets"].read(value_filter=f"dataset_id == '{dataset_id}'").concat().to_pandas()
-    if len(dataset) == 0:
-        raise KeyError("Unknown dataset_id")
+    if census is None:
+        with _open_soma(description["soma"]) as census:
+            dataset_h5ad_path = _get_dataset_h5ad_path(census, dataset_id)  # raises
+    else:
+        if census.uri.rstrip("/") != description["soma"]["uri"].rstrip("/"):
+            raise ValueError(f'The census provided is not the "{census_version}" Census version.')
+        dataset_h5ad_path = _get_dataset_h5ad_path(census, dataset_id)  # raises
 
     locator = description["h5ads"].copy()
     h5ads_base_uri = locator["uri"]
-    dataset_h5ad_path = dataset.dataset_h5ad_path.iloc[0]
     locator["uri"] = _uri_join(h5ads_base_uri, dataset_h5ad_path)
     return locator
 
 
+def _download_s3_file(fs: s3fs.S3FileSystem, uri: str, to_path: str) -> None:
+    """
+    Private. Download ``uri`` to ``to_path`` using concurrent byte-range reads, written in order. On error, the
+    partially written ``to_path`` is removed.
+    """
+    size = fs.size(uri)
+
+    def read_block(start: int) -> bytes:
+        block: bytes = fs.cat_file(uri, start=start, end=min(start + DOWNLOAD_BLOCK_SIZE, size))
+        return block
+
+    try:
+        with futures.ThreadPoolExecutor(max_workers=DOWNLOAD_MAX_WORKERS) as pool, open(to_path, "wb") as f:
+            # Sliding window: keep DOWNLOAD_MAX_WORKERS reads in flight, and write each block as soon as it and all
+            # preceding blocks are complete. This bounds the blocks held in memory, without stalling on the slowest
+            # read of a fixed batch.
+            pending: Deque[Future[bytes]] = deque()
+            for start in range(0, size, DOWNLOAD_BLOCK_SIZE):
+                if len(pending) == DOWNLOAD_MAX_WORKERS:
+                    f.write(pending.popleft().result())
+                pending.append(pool.submit(read_block, start))
+            while pending:
+                f.write(pending.popleft().result())
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(to_path)
+        raise
+
+
 def download_source_h5ad(dataset_id: str, to_path: str, *, census_version: str = DEFAULT_CENSUS_VERSION) -> None:
     """Download the source H5AD dataset, for the given `dataset_id`, to the user-specified
     file name.
@@ -229,4 +283,4 @@ def download_source_h5ad(dataset_id: str, to_path: str, *, census_version: str =
         anon=True,
         cache_regions=True,
     )
-    fs.get_file(locator["uri"], to_path)
+    _download_s3_file(fs, locator["uri"], to_path)
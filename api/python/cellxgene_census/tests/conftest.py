@@ -1,8 +1,13 @@
+from typing import List
+
 import pytest
 import tiledbsoma as soma
 
 TEST_MARKERS_SKIPPED_BY_DEFAULT = ["expensive", "experimental"]
 
+# Fail, rather than hang, if S3 stalls during a live_corpus test. Requires pytest-timeout.
+LIVE_CORPUS_TIMEOUT = 120  # seconds
+
 
 def pytest_addoption(parser: pytest.Parser) -> None:
     for test_option in TEST_MARKERS_SKIPPED_BY_DEFAULT:
@@ -31,6 +36,25 @@ def pytest_configure(config: pytest.Config) -> None:
     config.option.markexpr += " and ".join([f"not {m}" for m in excluded_markexprs])
 
 
+def pytest_collection_modifyitems(config: pytest.Config, items: List[pytest.Item]) -> None:
+    """
+    Bound the run time of `live_corpus` tests, unless they are also `expensive` or already specify a timeout.
+    """
+    for item in items:
+        if (
+            item.get_closest_marker("live_corpus")
+            and not item.get_closest_marker("expensive")
+            and not item.get_closest_marker("timeout")
+        ):
+            item.add_marker(pytest.mark.timeout(LIVE_CORPUS_TIMEOUT))
+
+
+@pytest.fixture(scope="session")
+def default_soma_context() -> soma.SOMATileDBContext:
+    """A default SOMATileDBContext, shared by all tests which do not depend on a fresh context."""
+    return soma.SOMATileDBContext()
+
+
 @pytest.fixture
 def small_mem_context() -> soma.SOMATileDBContext:
     """used to keep memory usage smaller for GHA runners."""
@@ -1,64 +1,149 @@
-import os
 import pathlib
 import re
 import time
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, cast
 from unittest.mock import patch
 
 import anndata
 import numpy as np
+import pyarrow.compute as pc
 import pytest
+import requests
 import requests_mock as rm
+import s3fs
 import tiledb
 import tiledbsoma as soma
 
 import cellxgene_census
-from cellxgene_census._open import DEFAULT_TILEDB_CONFIGURATION
-from cellxgene_census._release_directory import CELL_CENSUS_RELEASE_DIRECTORY_URL
+from cellxgene_census._open import DEFAULT_TILEDB_CONFIGURATION, _download_s3_file
+from cellxgene_census._release_directory import CELL_CENSUS_RELEASE_DIRECTORY_URL, CensusVersionDescription
+
+# TileDB config values are strings
+DEFAULT_TILEDB_CONFIGURATION_STR = {k: str(v) for k, v in DEFAULT_TILEDB_CONFIGURATION.items()}
+
+MSG_NO_VERSION = re.escape("Must specify either a census version or an explicit URI.")
+MSG_BAD_VERSION = re.escape(
+    'The "does-not-exist" Census version is not valid. Use get_census_version_directory() to retrieve available versions.'
+)
+MSG_WRONG_CENSUS = re.escape('The census provided is not the "latest" Census version.')
+
+
+def make_release_directory(release_build: str, release_date: str, aliases: Sequence[str] = ()) -> Dict[str, Any]:
+    """Return a release directory containing a single Census build, and any aliases which point at it."""
+    return {
+        **{alias: release_build for alias in aliases},
+        release_build: {
+            "release_date": release_date,
+            "release_build": release_build,
+            "soma": {
+                "uri": f"s3://cellxgene-data-public/cell-census/{release_build}/soma/",
+                "s3_region": "us-west-2",
+            },
+            "h5ads": {
+                "uri": f"s3://cellxgene-data-public/cell-census/{release_build}/h5ads/",
+                "s3_region": "us-west-2",
+            },
+        },
+    }
+
+
+DIRECTORY_MISSING_STABLE = make_release_directory("2022-11-01", "2022-11-30", aliases=["latest"])
+DIRECTORY_WITH_STABLE = make_release_directory("2022-10-01", "2022-10-30", aliases=["stable"])
+
+
+@pytest.fixture
+def release_directory() -> Dict[str, Any]:
+    """The mocked release directory contents. Override with `pytest.mark.parametrize`."""
+    return {}
+
+
+@pytest.fixture
+def directory_mock(requests_mock: rm.Mocker, release_directory: Dict[str, Any]) -> Any:
+    return requests_mock.get(CELL_CENSUS_RELEASE_DIRECTORY_URL, json=release_directory)
+
+
+@pytest.fixture(scope="session")
+def live_release_directory() -> Dict[str, Any]:
+    """The live release directory, fetched once per session."""
+    response = requests.get(CELL_CENSUS_RELEASE_DIRECTORY_URL, timeout=30)
+    response.raise_for_status()
+    return cast(Dict[str, Any], response.json())
+
+
+@pytest.fixture
+def live_directory_mock(requests_mock: rm.Mocker, live_release_directory: Dict[str, Any]) -> Any:
+    """Serve the live release directory from the session cache, rather than fetching it in every test."""
+    return requests_mock.get(CELL_CENSUS_RELEASE_DIRECTORY_URL, json=live_release_directory)
+
+
+@pytest.fixture
+def latest_description(live_directory_mock: Any) -> CensusVersionDescription:
+    """The 'latest' release description, resolved from the cached live release directory."""
+    return cellxgene_census.get_census_version_description("latest")
+
+
+@pytest.fixture(scope="session")
+def latest_census() -> Iterator[soma.Collection]:
+    """The 'latest' Census, opened once and shared by all tests in the session."""
+    with cellxgene_census.open_soma(census_version="latest") as census:
+        yield census
+
+
+@pytest.fixture(scope="session")
+def stable_census() -> Iterator[soma.Collection]:
+    """The 'stable' Census, opened once and shared by all tests in the session."""
+    with cellxgene_census.open_soma(census_version="stable") as census:
+        yield census
 
 
 @pytest.mark.live_corpus
-def test_open_soma_stable() -> None:
+def test_open_soma_stable(stable_census: soma.Collection, live_directory_mock: Any) -> None:
     # There should _always_ be a 'stable'
-    with cellxgene_census.open_soma(census_version="stable") as census:
-        assert census is not None
-        assert isinstance(census, soma.Collection)
+    census = stable_census
+    assert census is not None
+    assert isinstance(census, soma.Collection)
 
     # and it should be the latest, until the first "stable" build is available
     with cellxgene_census.open_soma() as default_census:
         assert default_census.uri == census.uri
-        for k, v in DEFAULT_TILEDB_CONFIGURATION.items():
-            assert census.context.tiledb_ctx.config()[k] == str(v)
+        tiledb_config = census.context.tiledb_ctx.config()
+        for k, v in DEFAULT_TILEDB_CONFIGURATION_STR.items():
+            assert tiledb_config[k] == v
 
     # TODO: After the first "stable" build is available, this commented-out code can be replace this above block
     # and it should always be the default
     # with cellxgene_census.open_soma() as default_census:
     #     assert default_census.uri == census.uri
-    #     for k, v in DEFAULT_TILEDB_CONFIGURATION.items():
-    #         assert census.context.tiledb_ctx.config()[k] == str(v)
+    #     tiledb_config = census.context.tiledb_ctx.config()
+    #     for k, v in DEFAULT_TILEDB_CONFIGURATION_STR.items():
+    #         assert tiledb_config[k] == v
 
 
 @pytest.mark.live_corpus
-def test_open_soma_latest() -> None:
+def test_open_soma_latest(latest_census: soma.Collection) -> None:
     # There should _always_ be a 'latest'
-    with cellxgene_census.open_soma(census_version="latest") as census:
-        assert census is not None
-        assert isinstance(census, soma.Collection)
+    assert latest_census is not None
+    assert isinstance(latest_census, soma.Collection)
 
 
 @pytest.mark.live_corpus
-def test_open_soma_with_context() -> None:
-    description = cellxgene_census.get_census_version_description("latest")
-    uri = description["soma"]["uri"]
-    s3_region = description["soma"].get("s3_region")
+def test_open_soma_with_context(
+    default_soma_context: soma.SOMATileDBContext,
+    latest_description: CensusVersionDescription,
+    live_directory_mock: Any,
+) -> None:
+    uri = latest_description["soma"]["uri"]
+    s3_region = latest_description["soma"].get("s3_region")
     assert s3_region == "us-west-2"
 
     # Verify the default region is set correctly in the TileDB context object.
-    with cellxgene_census.open_soma(census_version="latest", context=soma.SOMATileDBContext()) as census:
+    with cellxgene_census.open_soma(census_version="latest", context=default_soma_context) as census:
         assert census.context.tiledb_ctx.config()["vfs.s3.region"] == s3_region
 
     # Verify that config provided is passed through correctly
     soma_init_buffer_bytes = "221000"
-    timestamp_ms = int(time.time() * 1000) - 10  # don't use exactly current time, as that is the default
+    timestamp_ms = time.time_ns() // 1_000_000 - 10  # don't use exactly current time, as that is the default
     cfg = {
         "timestamp": timestamp_ms,
         "tiledb_config": {
@@ -66,7 +151,7 @@ def test_open_soma_with_context() -> None:
             "vfs.s3.region": s3_region,
         },
     }
-    context = soma.SOMATileDBContext().replace(**cfg)
+    context = default_soma_context.replace(**cfg)
     with cellxgene_census.open_soma(uri=uri, context=context) as census:
         assert census.uri == uri
         assert census.context.tiledb_ctx.config()["soma.init_buffer_bytes"] == soma_init_buffer_bytes
@@ -74,105 +159,104 @@ def test_open_soma_with_context() -> None:
 
 
 def test_open_soma_invalid_args() -> None:
-    with pytest.raises(
-        ValueError,
-        match=re.escape("Must specify either a census version or an explicit URI."),
-    ):
+    with pytest.raises(ValueError, match=MSG_NO_VERSION):
         cellxgene_census.open_soma(census_version=None)
 
 
-def test_open_soma_errors(requests_mock: rm.Mocker) -> None:
-    requests_mock.get(CELL_CENSUS_RELEASE_DIRECTORY_URL, json={})
-    with pytest.raises(
-        ValueError,
-        match=re.escape(
-            'The "does-not-exist" Census version is not valid. Use get_census_version_directory() to retrieve available versions.'
-        ),
-    ):
+def test_open_soma_errors(directory_mock: Any) -> None:
+    with pytest.raises(ValueError, match=MSG_BAD_VERSION):
         cellxgene_census.open_soma(census_version="does-not-exist")
 
 
-def test_open_soma_defaults_to_latest_if_missing_stable(requests_mock: rm.Mocker) -> None:
-    dir_missing_stable = {
-        "latest": "2022-11-01",
-        "2022-11-01": {
-            "release_date": "2022-11-30",
-            "release_build": "2022-11-01",
-            "soma": {
-                "uri": "s3://cellxgene-data-public/cell-census/2022-11-01/soma/",
-                "s3_region": "us-west-2",
-            },
-            "h5ads": {
-                "uri": "s3://cellxgene-data-public/cell-census/2022-11-01/h5ads/",
-                "s3_region": "us-west-2",
-            },
-        },
-    }
-
-    requests_mock.get(CELL_CENSUS_RELEASE_DIRECTORY_URL, json=dir_missing_stable)
-    with patch("cellxgene_census._open._open_soma") as m:
-        cellxgene_census.open_soma(census_version="stable")
-        m.assert_called_once_with(
-            {"uri": "s3://cellxgene-data-public/cell-census/2022-11-01/soma/", "s3_region": "us-west-2"}, None
-        )
-
-
-def test_open_soma_defaults_to_stable(requests_mock: rm.Mocker) -> None:
-    directory_with_stable = {
-        "stable": "2022-10-01",
-        "2022-10-01": {
-            "release_date": "2022-10-30",
-            "release_build": "2022-10-01",
-            "soma": {
-                "uri": "s3://cellxgene-data-public/cell-census/2022-10-01/soma/",
-                "s3_region": "us-west-2",
-            },
-            "h5ads": {
-                "uri": "s3://cellxgene-data-public/cell-census/2022-10-01/h5ads/",
-                "s3_region": "us-west-2",
-            },
-        },
-    }
-
-    requests_mock.get(CELL_CENSUS_RELEASE_DIRECTORY_URL, json=directory_with_stable)
+@pytest.mark.parametrize(
+    "release_directory,open_soma_kwargs,expected_locator",
+    [
+        pytest.param(
+            DIRECTORY_MISSING_STABLE,
+            {"census_version": "stable"},
+            {"uri": "s3://cellxgene-data-public/cell-census/2022-11-01/soma/", "s3_region": "us-west-2"},
+            id="defaults_to_latest_if_missing_stable",
+        ),
+        pytest.param(
+            DIRECTORY_WITH_STABLE,
+            {},
+            {"uri": "s3://cellxgene-data-public/cell-census/2022-10-01/soma/", "s3_region": "us-west-2"},
+            id="defaults_to_stable",
+        ),
+    ],
+)
+def test_open_soma_census_version_resolution(
+    directory_mock: Any, open_soma_kwargs: Dict[str, Any], expected_locator: Dict[str, Any]
+) -> None:
     with patch("cellxgene_census._open._open_soma") as m:
-        cellxgene_census.open_soma()
-        m.assert_called_once_with(
-            {"uri": "s3://cellxgene-data-public/cell-census/2022-10-01/soma/", "s3_region": "us-west-2"}, None
-        )
+        cellxgene_census.open_soma(**open_soma_kwargs)
+        m.assert_called_once_with(expected_locator, None)
 
 
 @pytest.mark.live_corpus
-def test_get_source_h5ad_uri() -> None:
-    with cellxgene_census.open_soma(census_version="latest") as census:
-        census_datasets = census["census_info"]["datasets"].read().concat().to_pandas()
+def test_get_source_h5ad_uri(latest_census: soma.Collection, live_directory_mock: Any) -> None:
+    census_datasets = (
+        latest_census["census_info"]["datasets"].read(column_names=["dataset_id", "dataset_h5ad_path"]).concat()
+    )
+    dataset_ids = census_datasets["dataset_id"]
+    dataset_h5ad_paths = census_datasets["dataset_h5ad_path"]
 
     rng = np.random.default_rng()
-    for idx in rng.choice(np.arange(len(census_datasets)), size=3, replace=False):
-        a_dataset = census_datasets.iloc[idx]
-        locator = cellxgene_census.get_source_h5ad_uri(a_dataset.dataset_id, census_version="latest")
+    for idx in rng.choice(len(census_datasets), size=3, replace=False):
+        dataset_id = dataset_ids[int(idx)].as_py()
+        locator = cellxgene_census.get_source_h5ad_uri(dataset_id, census_version="latest", census=latest_census)
         assert isinstance(locator, dict)
         assert "uri" in locator
-        assert locator["uri"].endswith(a_dataset.dataset_h5ad_path)
+        assert locator["uri"].endswith(dataset_h5ad_paths[int(idx)].as_py())
+
+
+@pytest.mark.parametrize("release_directory", [DIRECTORY_MISSING_STABLE])
+@pytest.mark.parametrize(
+    "census_uri",
+    [
+        "s3://cellxgene-data-public/cell-census/2022-11-01/soma/",
+        "s3://cellxgene-data-public/cell-census/2022-11-01/soma",
+    ],
+)
+def test_get_source_h5ad_uri_with_census(directory_mock: Any, census_uri: str) -> None:
+    census = cast(soma.Collection, SimpleNamespace(uri=census_uri))
+    with patch("cellxgene_census._open._get_dataset_h5ad_path", return_value="a-dataset.h5ad") as m:
+        locator = cellxgene_census.get_source_h5ad_uri("a-dataset", census_version="latest", census=census)
+        m.assert_called_once_with(census, "a-dataset")
+    assert locator == {
+        "uri": "s3://cellxgene-data-public/cell-census/2022-11-01/h5ads/a-dataset.h5ad",
+        "s3_region": "us-west-2",
+    }
+
 
+@pytest.mark.parametrize("release_directory", [DIRECTORY_MISSING_STABLE])
+def test_get_source_h5ad_uri_with_mismatched_census(directory_mock: Any) -> None:
+    census = cast(soma.Collection, SimpleNamespace(uri="s3://cellxgene-data-public/cell-census/2022-10-01/soma/"))
+    with patch("cellxgene_census._open._get_dataset_h5ad_path") as m:
+        with pytest.raises(ValueError, match=MSG_WRONG_CENSUS):
+            cellxgene_census.get_source_h5ad_uri("a-dataset", census_version="latest", census=census)
+        m.assert_not_called()
 
-def test_get_source_h5ad_uri_errors() -> None:
+
+def test_get_source_h5ad_uri_errors(live_directory_mock: Any) -> None:
     with pytest.raises(KeyError):
         cellxgene_census.get_source_h5ad_uri(dataset_id="no/such/id")
 
 
-@pytest.fixture
-def small_dataset_id() -> str:
-    with cellxgene_census.open_soma(census_version="latest") as census:
-        census_datasets = census["census_info"]["datasets"].read().concat().to_pandas()
-
-    small_dataset = census_datasets.nsmallest(1, "dataset_total_cell_count").iloc[0]
-    assert isinstance(small_dataset.dataset_id, str)
-    return small_dataset.dataset_id
+@pytest.fixture(scope="session")
+def small_dataset_id(latest_census: soma.Collection) -> str:
+    datasets = (
+        latest_census["census_info"]["datasets"].read(column_names=["dataset_id", "dataset_total_cell_count"]).concat()
+    )
+    cell_counts = datasets["dataset_total_cell_count"]
+    idx = pc.index(cell_counts, pc.min(cell_counts)).as_py()
+    dataset_id = datasets["dataset_id"][idx].as_py()
+    assert isinstance(dataset_id, str)
+    return dataset_id
 
 
 @pytest.mark.live_corpus
-def test_download_source_h5ad(tmp_path: pathlib.Path, small_dataset_id: str) -> None:
+def test_download_source_h5ad(tmp_path: pathlib.Path, small_dataset_id: str, live_directory_mock: Any) -> None:
     adata_path = tmp_path / "adata.h5ad"
     cellxgene_census.download_source_h5ad(small_dataset_id, adata_path.as_posix(), census_version="latest")
     assert adata_path.exists() and adata_path.is_file()
@@ -192,22 +276,67 @@ def test_download_source_h5ad_errors(tmp_path: pathlib.Path, small_dataset_id: s
         cellxgene_census.download_source_h5ad(small_dataset_id, "/tmp/dirname/", census_version="latest")
 
 
+class StubS3FileSystem:
+    """Serves ``data`` for any URI, recording the byte range of each ``cat_file`` call."""
+
+    def __init__(self, data: bytes, fail_at: Optional[int] = None):
+        self.data = data
+        self.fail_at = fail_at
+        self.ranges: List[Tuple[int, int]] = []
+
+    def size(self, uri: str) -> int:
+        return len(self.data)
+
+    def cat_file(self, uri: str, start: int, end: int) -> bytes:
+        self.ranges.append((start, end))
+        if start == self.fail_at:
+            raise OSError("injected read failure")
+        return self.data[start:end]
+
+
+@pytest.mark.parametrize("size", [0, 7, 10, 25, 30, 95])
+def test_download_s3_file(monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path, size: int) -> None:
+    monkeypatch.setattr(cellxgene_census._open, "DOWNLOAD_BLOCK_SIZE", 10)
+    monkeypatch.setattr(cellxgene_census._open, "DOWNLOAD_MAX_WORKERS", 3)
+    data = np.random.default_rng().bytes(size)
+    fs = StubS3FileSystem(data)
+    to_path = tmp_path / "data.h5ad"
+
+    _download_s3_file(cast(s3fs.S3FileSystem, fs), "s3://bucket/data.h5ad", to_path.as_posix())
+
+    assert to_path.read_bytes() == data
+    assert sorted(fs.ranges) == [(start, min(start + 10, size)) for start in range(0, size, 10)]
+
+
+def test_download_s3_file_removes_partial_file(monkeypatch: pytest.MonkeyPatch, tmp_path: pathlib.Path) -> None:
+    monkeypatch.setattr(cellxgene_census._open, "DOWNLOAD_BLOCK_SIZE", 10)
+    monkeypatch.setattr(cellxgene_census._open, "DOWNLOAD_MAX_WORKERS", 3)
+    fs = StubS3FileSystem(bytes(95), fail_at=50)
+    to_path = tmp_path / "data.h5ad"
+
+    with pytest.raises(OSError, match="injected read failure"):
+        _download_s3_file(cast(s3fs.S3FileSystem, fs), "s3://bucket/data.h5ad", to_path.as_posix())
+    assert not to_path.exists()
+
+
 @pytest.mark.live_corpus
-def test_opening_census_without_anon_access_fails_with_bogus_creds() -> None:
-    os.environ["AWS_ACCESS_KEY_ID"] = "fake_id"
-    os.environ["AWS_SECRET_ACCESS_KEY"] = "fake_key"
+def test_opening_census_without_anon_access_fails_with_bogus_creds(
+    monkeypatch: pytest.MonkeyPatch, live_directory_mock: Any
+) -> None:
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "fake_id")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "fake_key")
     # Passing an empty context
     with pytest.raises(tiledb.TileDBError, match=r"The AWS Access Key Id you provided does not exist in our records"):
         cellxgene_census.open_soma(census_version="latest", context=soma.SOMATileDBContext())
 
 
 @pytest.mark.live_corpus
-def test_can_open_with_anonymous_access() -> None:
+def test_can_open_with_anonymous_access(monkeypatch: pytest.MonkeyPatch, live_directory_mock: Any) -> None:
     """
     With anonymous access, `open_soma` must be able to access the census even with bogus credentials
     """
-    os.environ["AWS_ACCESS_KEY_ID"] = "fake_id"
-    os.environ["AWS_SECRET_ACCESS_KEY"] = "fake_key"
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "fake_id")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "fake_key")
     with cellxgene_census.open_soma(census_version="latest") as census:
         assert census is not None
         assert isinstance(census, soma.Collection)